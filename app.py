@@ -1,14 +1,19 @@
 from __future__ import annotations
 
-from datetime import datetime, date, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, date, timezone
+from functools import lru_cache
+from urllib.parse import quote
 import time
-import json
 import re
 from typing import Any, Dict, List, Optional, Tuple
 
+import orjson
 import pandas as pd
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # =========================================================
@@ -21,10 +26,62 @@ def secrets_get(key: str, default=None):
         return default
 
 
+# =========================================================
+# HTTP session (keep-alive + connection pool)
+# =========================================================
+GRAPH_RETRY_AFTER_MAX = 30.0  # seconds; longest single wait on a throttled Graph call
+
+
+class _GraphRetry(Retry):
+    # Retry blocks the script thread while it sleeps, and Graph's Retry-After can ask for
+    # minutes. Cap every sleep; a call still throttled after the retries returns its 429.
+    # (Overridden rather than passed as backoff_max/retry_after_max, which urllib3 1.x lacks.)
+    def parse_retry_after(self, retry_after: str) -> float:
+        return min(super().parse_retry_after(retry_after), GRAPH_RETRY_AFTER_MAX)
+
+    def get_backoff_time(self) -> float:
+        return min(super().get_backoff_time(), GRAPH_RETRY_AFTER_MAX)
+
+
+@st.cache_resource
+def graph_session() -> requests.Session:
+    # Streamlit re-executes this script on every rerun, so the session is held
+    # in cache_resource to keep the pooled TLS connections alive across reruns.
+    sess = requests.Session()
+    # up to 5 retries sleeping 0s, 1s, 2s, 4s, 8s (backoff_factor=0.5); a
+    # Retry-After header from Graph takes precedence, capped at GRAPH_RETRY_AFTER_MAX.
+    # Read timeouts are retried only once: every attempt waits out the full request timeout first
+    retry = _GraphRetry(
+        total=5,
+        read=1,
+        backoff_factor=0.5,
+        respect_retry_after_header=True,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # Graph throttles $batch POSTs and field PATCHes too; both only set
+        # field values, so replaying them is safe (Retry-After is honoured)
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST", "PATCH"},
+        raise_on_status=False,
+    )
+    sess.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=retry))
+    return sess
+
+
+def _json_bytes(obj: Any) -> bytes:
+    # request bodies; numpy scalars can come through from the pandas paths
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
 # =========================================================
 # Graph auth (client credentials)
 # =========================================================
-def graph_get_token() -> str:
+@st.cache_resource
+def _token_store() -> Dict[Tuple[str, str], Dict[str, Any]]:
+    # (tenant, client_id) -> {"access_token", "expires_at", "headers"}. This is an app-only
+    # token, identical for every session, so one process-wide copy is enough.
+    return {}
+
+
+def _token_entry() -> Dict[str, Any]:
     tenant = secrets_get("TENANT_ID", "")
     client_id = secrets_get("CLIENT_ID", "")
     client_secret = secrets_get("CLIENT_SECRET", "")
@@ -32,10 +89,11 @@ def graph_get_token() -> str:
     if not tenant or not client_id or not client_secret:
         raise Exception("Missing secrets: TENANT_ID / CLIENT_ID / CLIENT_SECRET")
 
-    cache = st.session_state.get("_graph_token_cache", {})
+    store = _token_store()
+    cache = store.get((tenant, client_id), {})
     now = int(time.time())
     if cache and cache.get("access_token") and cache.get("expires_at", 0) > now + 60:
-        return cache["access_token"]
+        return cache
 
     url = f"https://login.microsoftonline.com/{tenant}/oauth2/v2.0/token"
     data = {
@@ -44,46 +102,72 @@ def graph_get_token() -> str:
         "grant_type": "client_credentials",
         "scope": "https://graph.microsoft.com/.default",
     }
-    r = requests.post(url, data=data, timeout=30)
+    r = graph_session().post(url, data=data, timeout=30)
     if r.status_code != 200:
         raise Exception(f"Token request failed: {r.status_code} {r.text}")
 
-    js = r.json()
+    js = orjson.loads(r.content)
     token = js.get("access_token", "")
     if not token:
         raise Exception(f"Token is empty. Raw response: {r.text}")
 
     expires_in = int(js.get("expires_in", 3600))
-    st.session_state["_graph_token_cache"] = {"access_token": token, "expires_at": now + expires_in}
-    return token
+    entry = {
+        "access_token": token,
+        "expires_at": now + expires_in,
+        "headers": {"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+    }
+    store[(tenant, client_id)] = entry
+    return entry
+
+
+def graph_get_token() -> str:
+    return _token_entry()["access_token"]
+
+
+def graph_drop_token() -> None:
+    # force the next graph_get_token() to fetch a fresh token (e.g. after a 401)
+    _token_store().pop((secrets_get("TENANT_ID", ""), secrets_get("CLIENT_ID", "")), None)
 
 
 def graph_headers() -> dict:
-    token = graph_get_token()
-    return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    """
+    Auth + JSON headers, built once per token. Shared: callers must not mutate it.
+    """
+    return _token_entry()["headers"]
 
 
 # =========================================================
 # Graph: site / list ids
 # =========================================================
-def graph_get_site_id(host: str, site_path: str) -> str:
-    url = f"https://graph.microsoft.com/v1.0/sites/{host}:{site_path}"
-    r = requests.get(url, headers=graph_headers(), timeout=30)
+def graph_get_site_with_lists(host: str, site_path: str) -> Tuple[str, Dict[str, str]]:
+    """
+    Site id plus {list displayName: list id} in one request ($expand=lists).
+    """
+    url = f"https://graph.microsoft.com/v1.0/sites/{host}:{site_path}?$expand=lists($select=id,displayName)"
+    r = graph_session().get(url, headers=graph_headers(), timeout=30)
     if r.status_code != 200:
         raise Exception(f"Get site failed: {r.status_code} {r.text}")
-    site_id = r.json().get("id", "")
+    js = orjson.loads(r.content)
+    site_id = js.get("id", "")
     if not site_id:
         raise Exception(f"Site id empty. Raw: {r.text}")
-    return site_id
+    lists: Dict[str, str] = {}
+    for it in js.get("lists") or []:
+        name, list_id = it.get("displayName"), it.get("id")
+        # first match wins, like graph_get_list_id
+        if name and list_id and name not in lists:
+            lists[name] = list_id
+    return site_id, lists
 
 
 def graph_get_list_id(site_id: str, list_name: str) -> str:
     url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/lists?$top=200"
-    r = requests.get(url, headers=graph_headers(), timeout=30)
+    r = graph_session().get(url, headers=graph_headers(), timeout=30)
     if r.status_code != 200:
         raise Exception(f"Get lists failed: {r.status_code} {r.text}")
 
-    for it in r.json().get("value", []):
+    for it in orjson.loads(r.content).get("value", []):
         if it.get("displayName") == list_name:
             list_id = it.get("id", "")
             if list_id:
@@ -91,51 +175,253 @@ def graph_get_list_id(site_id: str, list_name: str) -> str:
     raise Exception(f"List not found: {list_name}")
 
 
-def get_site_id() -> str:
+# site / list ids don't change, so they are resolved once per process and
+# shared by every session (failed lookups raise and are not cached)
+@st.cache_resource(show_spinner=False)
+def _site_for(host: str, site_path: str) -> Tuple[str, Dict[str, str]]:
+    return graph_get_site_with_lists(host, site_path)
+
+
+@st.cache_resource(show_spinner=False)
+def _list_id_for(site_id: str, list_name: str) -> str:
+    return graph_get_list_id(site_id, list_name)
+
+
+def _site() -> Tuple[str, Dict[str, str]]:
     host = secrets_get("SP_HOST", "")
     site_path = secrets_get("SP_SITE_PATH", "")
     if not host or not site_path:
         raise Exception("Missing secrets: SP_HOST / SP_SITE_PATH")
+    return _site_for(host, site_path)
 
-    site_id = st.session_state.get("_sp_site_id")
-    if not site_id:
-        site_id = graph_get_site_id(host, site_path)
-        st.session_state["_sp_site_id"] = site_id
-    return site_id
+
+def get_site_id() -> str:
+    return _site()[0]
 
 
 def get_list_id_cached(list_name: str) -> str:
-    site_id = get_site_id()
-    cache = st.session_state.get("_sp_list_ids", {})
-    if list_name in cache:
-        return cache[list_name]
-    list_id = graph_get_list_id(site_id, list_name)
-    cache[list_name] = list_id
-    st.session_state["_sp_list_ids"] = cache
-    return list_id
+    site_id, lists = _site()
+    # not in the expanded page (e.g. very many lists): look it up on its own
+    return lists.get(list_name) or _list_id_for(site_id, list_name)
 
 
 # =========================================================
 # Graph: list items read / patch
 # =========================================================
-def graph_list_items_all(site_id: str, list_id: str, top: int = 2000) -> List[Dict[str, Any]]:
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/lists/{list_id}/items?$expand=fields&$top={top}"
+class GraphRequestError(Exception):
+    # non-200 from Graph, for callers that react to specific statuses
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+_NEXTLINK_RE = re.compile(rb'"@odata\.nextLink"\s*:\s*"((?:[^"\\]|\\.)*)"')
+GRAPH_ROOT = "https://graph.microsoft.com/"
+
+
+def _nextlink_guess(content: bytes) -> Optional[str]:
+    # nextLink read from the raw page bytes, before the page is decoded; None unless it is a Graph URL
+    m = _NEXTLINK_RE.search(content)
+    if not m:
+        return None
+    try:
+        url = orjson.loads(b'"' + m.group(1) + b'"')
+    except orjson.JSONDecodeError:
+        return None
+    return url if url.startswith(GRAPH_ROOT) else None
+
+
+def graph_list_items_all(
+    site_id: str, list_id: str, top: int = 2000, select_fields: Optional[List[str]] = None, filter_expr: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    # select_fields: only pull these columns (unknown names are simply not returned)
+    # filter_expr: OData $filter on fields/..., evaluated by SharePoint
+    expand = f"fields($select={','.join(select_fields)})" if select_fields else "fields"
+    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/lists/{list_id}/items?$expand={expand}&$top={top}"
+    if filter_expr:
+        url += f"&$filter={quote(filter_expr)}"
+    # filtering on a non-indexed column is refused unless the caller opts in
+    extra_headers = {"Prefer": "HonorNonIndexedQueriesWarningMayFailRandomly"} if filter_expr else {}
     out: List[Dict[str, Any]] = []
-    while url:
-        r = requests.get(url, headers=graph_headers(), timeout=30)
-        if r.status_code != 200:
-            raise Exception(f"Get items failed: {r.status_code} {r.text}")
-        js = r.json()
-        out.extend(js.get("value", []))
-        url = js.get("@odata.nextLink")
+
+    # Pages are chained by an opaque nextLink, so they can't be fetched in
+    # parallel. Instead the nextLink is pulled from the raw bytes and the next
+    # GET goes out on a worker thread while the current page is decoded.
+    # Headers are built once for the whole walk (not per page).
+    headers = {**graph_headers(), **extra_headers}
+    sess = graph_session()
+    refreshed = False
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        page_url = url
+        pending = ex.submit(sess.get, page_url, headers=headers, timeout=30)
+        while pending is not None:
+            r = pending.result()
+            if r.status_code == 401 and not refreshed:
+                # token expired mid-walk: refresh once and retry this page
+                refreshed = True
+                graph_drop_token()
+                headers = {**graph_headers(), **extra_headers}
+                pending = ex.submit(sess.get, page_url, headers=headers, timeout=30)
+                continue
+            if r.status_code != 200:
+                raise GraphRequestError(r.status_code, f"Get items failed: {r.status_code} {r.text}")
+
+            # the regex can also hit text inside a field value, so the guess is
+            # only prefetched when it points at Graph (it carries the token)
+            guess = _nextlink_guess(r.content)
+            pending = ex.submit(sess.get, guess, headers=headers, timeout=30) if guess else None
+
+            js = orjson.loads(r.content)
+            out.extend(js.get("value", []))
+            next_url = js.get("@odata.nextLink")
+            if next_url and not next_url.startswith(GRAPH_ROOT):
+                raise Exception(f"Get items failed: nextLink outside Graph: {next_url}")
+            if next_url != guess:
+                # wrong guess; the decoded body decides
+                if pending is not None:
+                    pending.result()
+                pending = ex.submit(sess.get, next_url, headers=headers, timeout=30) if next_url else None
+            page_url = next_url
     return out
 
 
-def graph_patch_item_fields(site_id: str, list_id: str, item_id: str, fields_patch: Dict[str, Any]) -> None:
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/lists/{list_id}/items/{item_id}/fields"
-    r = requests.patch(url, headers=graph_headers(), data=json.dumps(fields_patch), timeout=30)
-    if r.status_code not in (200, 204):
-        raise Exception(f"PATCH fields failed: {r.status_code} {r.text}")
+def graph_list_stamp(site_id: str, list_id: str) -> str:
+    """
+    Cheap change marker for a list (eTag + lastModifiedDateTime); "" if Graph returns neither.
+    """
+    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/lists/{list_id}?$select=id,eTag,lastModifiedDateTime"
+    r = graph_session().get(url, headers=graph_headers(), timeout=30)
+    if r.status_code != 200:
+        raise Exception(f"Get list failed: {r.status_code} {r.text}")
+    js = orjson.loads(r.content)
+    if not js.get("eTag") and not js.get("lastModifiedDateTime"):
+        return ""
+    return f"{js.get('eTag', '')}|{js.get('lastModifiedDateTime', '')}"
+
+
+# A stored list is re-read in full after this many seconds even if its stamp did not
+# change (the stamp is not guaranteed to move on every edit, e.g. some deletions).
+LIST_ITEMS_MAX_AGE = 3600
+
+
+@st.cache_resource
+def _list_items_store() -> Dict[Tuple[str, str, Tuple[str, ...]], Tuple[Tuple[str, str], float, List[Dict[str, Any]]]]:
+    # (site_id, list_id, select_fields) -> ((list stamp, filter), fetched at (monotonic), items);
+    # shared by all sessions. One entry per list: a different filter replaces it rather than piling up.
+    return {}
+
+
+def forget_list_items(site_id: str, list_id: str) -> None:
+    # drop the stored items of one list (every projection), so the next read re-pages it
+    store = _list_items_store()
+    for key in list(store):
+        if key[:2] == (site_id, list_id):
+            store.pop(key, None)
+
+
+def graph_list_items_cached(
+    site_id: str, list_id: str, top: int = 2000, select_fields: Optional[List[str]] = None, filter_expr: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    graph_list_items_all, but only re-downloaded when the list stamp changed
+    or the stored copy is older than LIST_ITEMS_MAX_AGE.
+    Callers must not mutate the returned items (they are shared).
+    """
+    stamp = graph_list_stamp(site_id, list_id)
+    key = (site_id, list_id, tuple(select_fields or ()))
+    version = (stamp, filter_expr or "")
+    store = _list_items_store()
+    hit = store.get(key)
+    if stamp and hit and hit[0] == version and time.monotonic() - hit[1] < LIST_ITEMS_MAX_AGE:
+        return hit[2]
+
+    items = graph_list_items_all(site_id, list_id, top=top, select_fields=select_fields, filter_expr=filter_expr)
+    store[key] = (version, time.monotonic(), items)
+    return items
+
+
+GRAPH_BATCH_MAX = 20  # Graph JSON batching limit per request
+
+
+def graph_batch(sub_requests: List[Dict[str, Any]], headers: Optional[Dict[str, str]] = None, sess: Optional[requests.Session] = None) -> List[Dict[str, Any]]:
+    """
+    POST up to GRAPH_BATCH_MAX sub-requests to /$batch.
+    Returns the sub-responses (each has id / status / body).
+    """
+    url = "https://graph.microsoft.com/v1.0/$batch"
+    sess = sess or graph_session()
+    r = sess.post(url, headers=headers or graph_headers(), data=_json_bytes({"requests": sub_requests}), timeout=30)
+    if r.status_code != 200:
+        raise Exception(f"$batch failed: {r.status_code} {r.text}")
+    return orjson.loads(r.content).get("responses", [])
+
+
+GRAPH_BATCH_RETRIES = 3  # extra rounds for throttled sub-requests
+_SUB_RETRY_STATUSES = frozenset((429, 503, 504))
+
+
+def _sub_retry_after(resp: Dict[str, Any], attempt: int) -> float:
+    # sub-responses carry their own Retry-After; otherwise back off 1s, 2s, 4s...
+    for k, v in (resp.get("headers") or {}).items():
+        if k.lower() == "retry-after":
+            return min(_to_float(v, 1.0), GRAPH_RETRY_AFTER_MAX)
+    return float(2 ** attempt)
+
+
+def graph_batch_patch_items(site_id: str, jobs: List[Tuple[str, str, Dict[str, Any]]], max_workers: int = 4) -> None:
+    """
+    jobs = [(list_id, item_id, fields_patch), ...]
+    Sent as $batch PATCHes, GRAPH_BATCH_MAX per HTTP call; chunks go out concurrently.
+    Throttled sub-requests (429/503/504 inside the batch) are re-sent after Retry-After.
+    """
+    if not jobs:
+        return
+
+    sub_requests = [{
+        "id": str(i),
+        "method": "PATCH",
+        "url": f"/sites/{site_id}/lists/{list_id}/items/{item_id}/fields",
+        "body": fields_patch,
+        "headers": {"Content-Type": "application/json"},
+    } for i, (list_id, item_id, fields_patch) in enumerate(jobs)]
+
+    # resolved on the script thread; worker threads must not touch st.* state
+    headers = graph_headers()
+    sess = graph_session()
+    failed: List[Dict[str, Any]] = []
+    pending = sub_requests
+    for attempt in range(GRAPH_BATCH_RETRIES + 1):
+        chunks = [pending[i:i + GRAPH_BATCH_MAX] for i in range(0, len(pending), GRAPH_BATCH_MAX)]
+        responses: List[Dict[str, Any]] = []
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = [ex.submit(graph_batch, chunk, headers, sess) for chunk in chunks]
+            for fut in as_completed(futures):
+                responses.extend(fut.result())
+
+        retry_ids: List[int] = []
+        wait = 0.0
+        for resp in responses:
+            status = _to_int(resp.get("status"), 0)
+            if status in (200, 204):
+                continue
+            if status in _SUB_RETRY_STATUSES and attempt < GRAPH_BATCH_RETRIES:
+                retry_ids.append(_to_int(resp.get("id"), 0))
+                wait = max(wait, _sub_retry_after(resp, attempt))
+            else:
+                failed.append(resp)
+        if not retry_ids:
+            break
+        time.sleep(wait)
+        pending = [sub_requests[i] for i in sorted(retry_ids)]
+
+    errors: List[str] = []
+    for resp in sorted(failed, key=lambda x: _to_int(x.get("id"), 0)):
+        status = _to_int(resp.get("status"), 0)
+        item_id = jobs[_to_int(resp.get("id"), 0)][1]
+        err = ((resp.get("body") or {}).get("error") or {}).get("message", "")
+        errors.append(f"item {item_id}: {status} {err}".strip())
+    if errors:
+        raise Exception(f"PATCH fields failed: {'; '.join(errors)}")
 
 
 # =========================================================
@@ -143,24 +429,77 @@ def graph_patch_item_fields(site_id: str, list_id: str, item_id: str, fields_pat
 # =========================================================
 def graph_list_columns(site_id: str, list_id: str) -> List[Dict[str, Any]]:
     url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/lists/{list_id}/columns?$top=200"
-    r = requests.get(url, headers=graph_headers(), timeout=30)
+    r = graph_session().get(url, headers=graph_headers(), timeout=30)
     if r.status_code != 200:
         raise Exception(f"Get columns failed: {r.status_code} {r.text}")
-    return r.json().get("value", [])
+    return orjson.loads(r.content).get("value", [])
+
+
+def graph_list_columns_many(site_id: str, list_ids: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Columns for several lists in one $batch call.
+    Returns {list_id: columns}.
+    """
+    list_ids = list(dict.fromkeys(list_ids))
+    sub_requests = [{
+        "id": str(i),
+        "method": "GET",
+        "url": f"/sites/{site_id}/lists/{list_id}/columns?$top=200",
+    } for i, list_id in enumerate(list_ids)]
+
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    for i in range(0, len(sub_requests), GRAPH_BATCH_MAX):
+        for resp in graph_batch(sub_requests[i:i + GRAPH_BATCH_MAX]):
+            status = _to_int(resp.get("status"), 0)
+            body = resp.get("body") or {}
+            if status != 200:
+                err = (body.get("error") or {}).get("message", "")
+                raise Exception(f"Get columns failed: {status} {err}".strip())
+            out[list_ids[_to_int(resp.get("id"), 0)]] = body.get("value", [])
+    return out
 
 
+_NORM_RE = re.compile(r"[^a-z0-9]+")
+
+
+@lru_cache(maxsize=2048)
 def _norm(s: str) -> str:
     s = (s or "").strip().lower()
     # remove non-alnum for fuzzy match
-    return re.sub(r"[^a-z0-9]+", "", s)
+    return _NORM_RE.sub("", s)
+
+
+ColumnMaps = Tuple[Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, str]]
+
+
+def column_name_maps(columns: List[Dict[str, Any]]) -> ColumnMaps:
+    """
+    (name_map, disp_map, norm_name_map, norm_disp_map) -> internal name.
+    Build once per column list and reuse for every lookup.
+    """
+    name_map: Dict[str, str] = {}
+    disp_map: Dict[str, str] = {}
+    norm_name_map: Dict[str, str] = {}
+    norm_disp_map: Dict[str, str] = {}
+    for c in columns:
+        n = c.get("name") or ""
+        d = c.get("displayName") or ""
+        if n:
+            name_map[n] = n
+            norm_name_map[_norm(n)] = n
+        if d and n:
+            disp_map[d] = n
+            norm_disp_map[_norm(d)] = n
+    return name_map, disp_map, norm_name_map, norm_disp_map
 
 
-def resolve_internal_name(columns: List[Dict[str, Any]], *candidates: str) -> Optional[str]:
+def resolve_internal_name(columns: List[Dict[str, Any]], *candidates: str, maps: Optional[ColumnMaps] = None) -> Optional[str]:
     """
     Try match by:
     1) exact column.name
     2) exact column.displayName
     3) normalized compare (remove symbols/spaces)
+    Pass maps=column_name_maps(columns) when resolving many names against one list.
     """
     if not columns:
         return None
@@ -169,10 +508,9 @@ def resolve_internal_name(columns: List[Dict[str, Any]], *candidates: str) -> Op
     if not cand_list:
         return None
 
-    # exact name / displayName
-    name_map = {c.get("name"): c.get("name") for c in columns if c.get("name")}
-    disp_map = {c.get("displayName"): c.get("name") for c in columns if c.get("displayName") and c.get("name")}
+    name_map, disp_map, norm_name_map, norm_disp_map = maps or column_name_maps(columns)
 
+    # exact name / displayName
     for cand in cand_list:
         if cand in name_map:
             return name_map[cand]
@@ -180,16 +518,6 @@ def resolve_internal_name(columns: List[Dict[str, Any]], *candidates: str) -> Op
             return disp_map[cand]
 
     # normalized fuzzy
-    norm_name_map = {}
-    norm_disp_map = {}
-    for c in columns:
-        n = c.get("name") or ""
-        d = c.get("displayName") or ""
-        if n:
-            norm_name_map[_norm(n)] = n
-        if d and n:
-            norm_disp_map[_norm(d)] = n
-
     for cand in cand_list:
         nc = _norm(cand)
         if nc in norm_name_map:
@@ -200,46 +528,67 @@ def resolve_internal_name(columns: List[Dict[str, Any]], *candidates: str) -> Op
     return None
 
 
-def patch_fields_safe_by_guess(site_id: str, list_id: str, item_id: str, columns: List[Dict[str, Any]], desired: Dict[str, Tuple[Any, List[str]]]) -> Dict[str, Any]:
+def resolve_field_names(columns: List[Dict[str, Any]], candidates: Dict[str, List[str]]) -> Tuple[Dict[str, str], List[str]]:
     """
-    desired = { logical_key: (value, [candidate column names...]) }
-    We resolve to real internal names, skip missing ones.
+    candidates = { logical_key: [candidate column names...] }
+    Returns ({logical_key: internal_name}, missing_logical_keys).
     """
-    patch: Dict[str, Any] = {}
+    maps = column_name_maps(columns)
+    names: Dict[str, str] = {}
     missing: List[str] = []
-
-    for logical, (val, cands) in desired.items():
-        internal = resolve_internal_name(columns, *cands)
+    for logical, cands in candidates.items():
+        internal = resolve_internal_name(columns, *cands, maps=maps)
         if internal:
-            patch[internal] = val
+            names[logical] = internal
         else:
             missing.append(logical)
+    return names, missing
+
+
+def resolve_fields_patch(columns: List[Dict[str, Any]], desired: Dict[str, Tuple[Any, List[str]]]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    desired = { logical_key: (value, [candidate column names...]) }
+    Resolved to real internal names; missing ones are skipped.
+    Returns (patch, missing_logical_keys).
+    """
+    names, missing = resolve_field_names(columns, {k: cands for k, (_, cands) in desired.items()})
+    patch: Dict[str, Any] = {names[k]: val for k, (val, _) in desired.items() if k in names}
 
     if not patch:
         raise Exception("No fields resolved for PATCH (all missing).")
 
-    graph_patch_item_fields(site_id, list_id, item_id, patch)
-    return {"patched": list(patch.keys()), "missing": missing}
+    return patch, missing
 
 
 # =========================================================
 # parsing helpers
 # =========================================================
 def _to_float(v, default=0.0) -> float:
+    # plain type checks first; exceptions only for genuinely odd input
+    if v is None or v == "":
+        return float(default)
+    t = type(v)
+    if t is float:
+        return v
+    if t is int or t is bool:
+        return float(v)
     try:
-        if v is None or v == "":
-            return float(default)
         return float(v)
-    except Exception:
+    except (TypeError, ValueError):
         return float(default)
 
 
 def _to_int(v, default=0) -> int:
+    if v is None or v == "":
+        return int(default)
+    t = type(v)
+    if t is int:
+        return v
+    if t is bool:
+        return int(v)
     try:
-        if v is None or v == "":
-            return int(default)
         return int(float(v))
-    except Exception:
+    except (TypeError, ValueError, OverflowError):
         return int(default)
 
 
@@ -249,48 +598,89 @@ def _to_text(v) -> str:
     return str(v)
 
 
+_TRUE_SET = frozenset(("true", "yes", "y", "1", "on"))
+
+
 def _to_bool(v) -> bool:
     if isinstance(v, bool):
         return v
     if v is None:
         return False
-    s = str(v).strip().lower()
-    return s in ("true", "yes", "y", "1", "on")
+    return str(v).strip().lower() in _TRUE_SET
+
+
+_ISO_DATE_RE = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})")
+
+
+# US-style M/D/YYYY, as typed into SharePoint text columns
+_MDY_RE = re.compile(r"^([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})$")
 
 
 def _parse_date(v) -> Optional[date]:
     if not v:
         return None
-    s = str(v).strip()
+    if isinstance(v, datetime):
+        return v.date()
+    if isinstance(v, date):
+        return v
+    return _parse_date_str(str(v).strip())
+
+
+@lru_cache(maxsize=4096)
+def _parse_date_str(s: str) -> Optional[date]:
+    # many batches share a WorkDate, so the same strings come through repeatedly
     try:
         if "T" in s:
             return datetime.fromisoformat(s.replace("Z", "+00:00")).date()
         if "-" in s and len(s) >= 10:
+            # YYYY-MM-DD prefix without strptime; anything after it is ignored
+            m = _ISO_DATE_RE.fullmatch(s, 0, 10)
+            if m:
+                return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
             return datetime.strptime(s[:10], "%Y-%m-%d").date()
         if "/" in s:
-            return datetime.strptime(s, "%m/%d/%Y").date()
-    except Exception:
+            m = _MDY_RE.match(s)
+            return date(int(m.group(3)), int(m.group(1)), int(m.group(2))) if m else None
+    except ValueError:
         return None
     return None
 
 
-def _parse_dt(v) -> Optional[datetime]:
-    if not v:
-        return None
-    s = str(v).strip()
-    try:
-        if "T" in s:
-            return datetime.fromisoformat(s.replace("Z", "+00:00"))
-        return datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
-    except Exception:
-        return None
+def flatten_fields(fields: Dict[str, Any], aliases: Dict[str, List[str]]) -> Dict[str, Any]:
+    """
+    Resolve every alias list once: canonical key -> first non-empty value.
+    Keys with no value are left out, so .get(key, default) gives the default
+    when every candidate is missing or None / "".
+    """
+    out: Dict[str, Any] = {}
+    for key, cands in aliases.items():
+        for c in cands:
+            v = fields.get(c)
+            if v not in (None, ""):
+                out[key] = v
+                break
+    return out
+
+
+def fields_frame(items: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    One row per list item, one object column per field (missing -> NaN).
+    Values are kept as Graph returned them; use coalesce_column to read aliases.
+    """
+    return pd.DataFrame([it.get("fields") or {} for it in items], dtype=object)
 
 
-def _get_any(fields: Dict[str, Any], keys: List[str], default=None):
-    for k in keys:
-        if k in fields and fields.get(k) not in (None, ""):
-            return fields.get(k)
-    return default
+def coalesce_column(raw: pd.DataFrame, keys: List[str], default=None) -> pd.Series:
+    """
+    Per row, the value of the first of keys that isn't missing / None / "" (else default).
+    """
+    out = pd.Series([default] * len(raw), index=raw.index, dtype=object)
+    # last candidate first, so earlier candidates overwrite it
+    for k in reversed(keys):
+        if k in raw.columns:
+            col = raw[k]
+            out = col.where(col.notna() & (col != ""), out)
+    return out
 
 
 # =========================================================
@@ -341,6 +731,13 @@ LOG_RAWKG = "RawKg"
 LOG_WASTAGEKG = "WastageKg"
 LOG_CALCAT = "CalculatedAt"
 
+# order of the rounded numeric outputs in calc_for_batch
+CALC_NUMERIC_KEYS = (
+    LOG_TOTALOUTPUT, LOG_TOTALMANMIN, LOG_MINPERCT, LOG_WASTERATE,
+    LOG_LABOURCOST, LOG_MATCOST, LOG_EXTRACOST, LOG_TOTALCOST,
+    LOG_PROFITPERCT, LOG_PROFITTOTAL, LOG_RAWKG, LOG_WASTAGEKG,
+)
+
 # labour list columns
 LAB_COL_BATCH_LOOKUP_ID = ["BatchLookupId"]
 LAB_COL_BATCH_TEXT = ["Batch", "BatchNo", "Title"]
@@ -352,113 +749,283 @@ LAB_COL_ROLE = ["Role"]
 LAB_OUT_DURATION = "DurationMinutes"
 LAB_OUT_MANMIN = "ManMinutes"
 
+# canonical key -> candidate columns, for flatten_fields()
+BATCH_FIELD_ALIASES: Dict[str, List[str]] = {
+    "BatchNo": COL_BATCHNO,
+    "WorkDate": COL_WORKDATE,
+    "PackType": COL_PACKTYPE,
+    "TotalBoxes": COL_TOTALBOXES,
+    "CtPerBox": COL_CTPERBOX,
+    "LooseCT": COL_LOOSECT,
+    "TotalRawMaterial": COL_TOTALRAW,
+    "RawMaterialUnit": COL_RAWUNIT,
+    "MaterialUnitWeightKg": COL_UNITWEIGHT,
+    "Wastage": COL_WASTAGE,
+    "WastageUnit": COL_WASTAGEUNIT,
+    "WagePerHour": COL_WAGEPH,
+    "MaterialCost": COL_MATERIALCOST,
+    "IncludeExtraCost": COL_INCLUDEEXTRA,
+    "ExtraCostPct": COL_EXTRAPCT,
+    "SellPricePerCT": COL_SELLPRICE,
+}
+
+# columns actually read from each list (used for $select)
+SELECT_P_BATCHES = list(dict.fromkeys(
+    COL_BATCHNO + COL_WORKDATE + COL_PACKTYPE
+    + COL_TOTALBOXES + COL_CTPERBOX + COL_LOOSECT
+    + COL_TOTALRAW + COL_RAWUNIT + COL_UNITWEIGHT
+    + COL_WASTAGE + COL_WASTAGEUNIT
+    + COL_WAGEPH + COL_MATERIALCOST
+    + COL_INCLUDEEXTRA + COL_EXTRAPCT + COL_SELLPRICE
+))
+SELECT_P_LABOUR = list(dict.fromkeys(
+    LAB_COL_BATCH_LOOKUP_ID + LAB_COL_BATCH_TEXT
+    + LAB_COL_START + LAB_COL_END + LAB_COL_PEOPLE + LAB_COL_ROLE
+))
+
 
 # =========================================================
 # Fetchers
 # =========================================================
-def fetch_p_batches() -> List[Dict[str, Any]]:
+def workdate_filter(start: date, end: date) -> str:
+    # whole days, compared on the stored UTC value like _parse_date does
+    col = COL_WORKDATE[0]
+    return f"fields/{col} ge '{start.isoformat()}T00:00:00Z' and fields/{col} le '{end.isoformat()}T23:59:59Z'"
+
+
+def fetch_p_batches(start: Optional[date] = None, end: Optional[date] = None) -> List[Dict[str, Any]]:
+    """
+    P_Batches items; with start/end only WorkDates in [start, end] are requested
+    (server-side $filter, see workdate_pushdown). Without them, the whole list.
+    """
     site_id = get_site_id()
     list_id = get_list_id_cached(LIST_P_BATCHES)
-    return graph_list_items_all(site_id, list_id, top=2000)
+    filter_expr = workdate_filter(start, end) if start and end else None
+    return graph_list_items_cached(site_id, list_id, top=2000, select_fields=SELECT_P_BATCHES, filter_expr=filter_expr)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def batch_table(start: Optional[date] = None, end: Optional[date] = None) -> pd.DataFrame:
+    """
+    One row per fetch_p_batches(start, end) item that has a WorkDate: item,
+    work_date (datetime64) and the selectbox label. Parsed once per fetch.
+    """
+    items = fetch_p_batches(start, end)
+    raw = fields_frame(items)
+    # _parse_date is memoized, and WorkDates repeat a lot
+    wd = coalesce_column(raw, COL_WORKDATE).map(_parse_date)
+    has_wd = wd.notna()
+    wd = wd[has_wd]
+    batch_no = coalesce_column(raw, COL_BATCHNO, "")[has_wd].astype(str).str.strip()
+    return pd.DataFrame({
+        "item": pd.Series(items, index=raw.index, dtype=object)[has_wd],
+        "work_date": pd.to_datetime(wd, errors="coerce"),
+        "label": batch_no + "  (" + wd.map(date.isoformat).astype(str) + ")",
+    }).reset_index(drop=True)
+
+
+@st.cache_resource
+def _filter_refused_lists() -> set:
+    # list ids that answered the WorkDate $filter with a refusal; read whole from then on
+    return set()
+
+
+def _filter_refused(e: GraphRequestError) -> bool:
+    # 400 = the filter isn't supported on this list; large lists can also hit the view threshold
+    return e.status_code == 400 or "threshold" in str(e).lower()
+
+
+def workdate_pushdown(list_id: str) -> bool:
+    """
+    True when the WorkDate range can be filtered by SharePoint: WorkDate must be a
+    Date/Time column (on a text column such as "5/3/2024" SharePoint compares
+    strings and quietly returns nothing) and the list must not have refused it before.
+    """
+    if list_id in _filter_refused_lists():
+        return False
+    try:
+        cols = fetch_list_columns((list_id,))[list_id]
+    except Exception:
+        # column metadata unavailable: reading the whole list is always correct
+        return False
+    return any(c.get("name") == COL_WORKDATE[0] and c.get("dateTime") is not None for c in cols)
+
+
+def batch_options_in_range(start: date, end: date) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    (label, item) for every batch whose WorkDate is within [start, end], in list order.
+    Without a server-side filter the whole list is parsed once and shared by every range.
+    """
+    list_id = get_list_id_cached(LIST_P_BATCHES)
+    bounds = (start, end) if workdate_pushdown(list_id) else (None, None)
+    try:
+        df = batch_table(*bounds)
+    except GraphRequestError as e:
+        if bounds == (None, None) or not _filter_refused(e):
+            raise
+        _filter_refused_lists().add(list_id)
+        df = batch_table(None, None)
+    in_range = df[(df["work_date"] >= pd.Timestamp(start)) & (df["work_date"] <= pd.Timestamp(end))]
+    return list(zip(in_range["label"].tolist(), in_range["item"].tolist()))
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_list_columns(list_ids: Tuple[str, ...]) -> Dict[str, List[Dict[str, Any]]]:
+    return graph_list_columns_many(get_site_id(), list(list_ids))
 
 
+@st.cache_data(ttl=300, show_spinner=False)
 def fetch_labour_lines() -> List[Dict[str, Any]]:
     site_id = get_site_id()
     list_id = get_list_id_cached(LIST_P_LABOUR)
-    return graph_list_items_all(site_id, list_id, top=2000)
+    return graph_list_items_cached(site_id, list_id, top=2000, select_fields=SELECT_P_LABOUR)
+
+
+LABOUR_LINE_COLS = ["sp_item_id", "start", "end", "people", "role"]
+
+
+def labour_lines_frame(items: List[Dict[str, Any]], raw: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Flatten raw labour list items into LABOUR_LINE_COLS (values as stored in SharePoint).
+    Pass raw=fields_frame(items) if it was already built.
+    """
+    raw = fields_frame(items) if raw is None else raw
+    role = coalesce_column(raw, LAB_COL_ROLE, "")
+    return pd.DataFrame({
+        "sp_item_id": pd.Series([it.get("id") for it in items], index=raw.index, dtype=object),
+        "start": coalesce_column(raw, LAB_COL_START, None),
+        "end": coalesce_column(raw, LAB_COL_END, None),
+        "people": coalesce_column(raw, LAB_COL_PEOPLE, 0),
+        "role": role.where(role.notna(), "").astype(str),
+    }, columns=LABOUR_LINE_COLS)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def index_labour_lines() -> Tuple[pd.DataFrame, Dict[int, List[int]], Dict[str, List[int]]]:
+    """
+    Fetch labour lines once, flatten them and index them by batch.
+    Returns (labour_lines_df, by_lookup_id, by_batch_text); the dicts map to row positions.
+    """
+    items = fetch_labour_lines()
+    raw = fields_frame(items)
+
+    # same coercion as _to_int: numeric text is accepted, fractions truncate, junk -> 0
+    lk = pd.to_numeric(coalesce_column(raw, LAB_COL_BATCH_LOOKUP_ID, 0), errors="coerce")
+    lk = lk.where(lk.abs() < float("inf"), 0).astype("int64")
+    bt = coalesce_column(raw, LAB_COL_BATCH_TEXT, "")
+    bt = bt.where(bt.notna(), "").astype(str).str.strip()
+
+    # groupby(...).indices -> {key: row positions}, in list order
+    by_lookup_id = {int(k): v.tolist() for k, v in lk.groupby(lk).indices.items() if k}
+    by_text = {k: v.tolist() for k, v in bt.groupby(bt).indices.items() if k}
+    return labour_lines_frame(items, raw), by_lookup_id, by_text
+
+
+def reload_lists(start: date, end: date) -> None:
+    """
+    Load / Refresh: drop what the view for [start, end] is built from, so it is re-read.
+    That is both lists' stored items, the batch tables this range can use, the labour
+    index and the P_Batches columns; batch tables of other ranges keep their TTL.
+    """
+    site_id = get_site_id()
+    pb_list_id = get_list_id_cached(LIST_P_BATCHES)
+    for list_id in (pb_list_id, get_list_id_cached(LIST_P_LABOUR)):
+        forget_list_items(site_id, list_id)
+    # same positional args as batch_options_in_range, so the keys match
+    batch_table.clear(start, end)
+    batch_table.clear(None, None)
+    fetch_labour_lines.clear()
+    index_labour_lines.clear()
+    fetch_list_columns.clear((pb_list_id,))
 
 
 # =========================================================
 # Core logic: unit conversion + calculations
 # =========================================================
+_UNIT_STRIP_DOTS = str.maketrans("", "", ".")
+
+# normalized unit -> how it converts to kg
+#   "kg":    already kg
+#   "count": qty * unit weight (boxes, cartons, ...)
+#   "pack":  qty * unit weight when known, else treated as kg
+_UNIT_KIND = {
+    **dict.fromkeys(("kg", "kgs", "kilogram", "kilograms"), "kg"),
+    **dict.fromkeys(("box", "boxes", "carton", "cartons", "crate", "crates", "ctn", "ctns"), "count"),
+    **dict.fromkeys(("loose", "loosekg", "bulk"), "kg"),
+    **dict.fromkeys(("pack", "packs", "pkt", "pkts"), "pack"),
+}
+
+
+@lru_cache(maxsize=256)
 def normalize_unit(u: str) -> str:
-    s = (u or "").strip().lower().replace(".", "")
-    return s
+    return (u or "").strip().lower().translate(_UNIT_STRIP_DOTS)
 
 
 def convert_to_kg(qty: float, unit: str, unit_weight_kg: float) -> float:
-    u = normalize_unit(unit)
+    kind = _UNIT_KIND.get(normalize_unit(unit), "kg")
 
-    if u in ("kg", "kgs", "kilogram", "kilograms"):
-        return float(qty)
-
-    if u in ("box", "boxes", "carton", "cartons", "crate", "crates", "ctn", "ctns"):
+    if kind == "count":
         return float(qty) * float(unit_weight_kg)
 
-    if u in ("loose", "loosekg", "bulk"):
-        return float(qty)
-
-    if u in ("pack", "packs", "pkt", "pkts"):
-        if unit_weight_kg and unit_weight_kg > 0:
-            return float(qty) * float(unit_weight_kg)
-        return float(qty)
+    if kind == "pack" and unit_weight_kg and unit_weight_kg > 0:
+        return float(qty) * float(unit_weight_kg)
 
     return float(qty)
 
 
-def calc_for_batch(batch_fields: Dict[str, Any], labour_items: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
-    total_boxes = _to_float(_get_any(batch_fields, COL_TOTALBOXES, 0), 0)
-    ct_per_box = _to_float(_get_any(batch_fields, COL_CTPERBOX, 0), 0)
-    loose_ct = _to_float(_get_any(batch_fields, COL_LOOSECT, 0), 0)
+def _shown_time(raw: pd.Series, parsed: pd.Series) -> pd.Series:
+    # the time as SharePoint stored it (own offset, not UTC); blank where it didn't parse
+    return raw.where(parsed.notna(), "").astype(str)
 
-    total_raw = _to_float(_get_any(batch_fields, COL_TOTALRAW, 0), 0)
-    raw_unit = _to_text(_get_any(batch_fields, COL_RAWUNIT, ""))
-    unit_weight_kg = _to_float(_get_any(batch_fields, COL_UNITWEIGHT, 0), 0)
 
-    wastage = _to_float(_get_any(batch_fields, COL_WASTAGE, 0), 0)
-    wastage_unit = _to_text(_get_any(batch_fields, COL_WASTAGEUNIT, "kg"))
+LABOUR_ROW_COLS = ["sp_item_id", "start_time", "end_time", "people", "duration_minutes", "man_minutes", "role"]
 
-    wage_per_hour = _to_float(_get_any(batch_fields, COL_WAGEPH, 0), 0)
-    material_cost = _to_float(_get_any(batch_fields, COL_MATERIALCOST, 0), 0)
-
-    include_extra = _to_bool(_get_any(batch_fields, COL_INCLUDEEXTRA, False))
-    extra_pct = _to_float(_get_any(batch_fields, COL_EXTRAPCT, 0), 0)
-
-    sell_price_per_ct = _to_float(_get_any(batch_fields, COL_SELLPRICE, 0), 0)
 
+def aggregate_labour(df: pd.DataFrame) -> Tuple[pd.DataFrame, float]:
+    """
+    Duration / man-minutes for every labour line, computed column-wise.
+    df has LABOUR_LINE_COLS (see labour_lines_frame).
+    Naive times are treated as UTC; end < start means the shift ran past midnight.
+    start_time / end_time show the stored values; the UTC parse is only used for durations.
+    Returns (labour_df, total_man_minutes); labour_df has LABOUR_ROW_COLS, one row per line.
+    """
+    if df.empty:
+        return pd.DataFrame(columns=LABOUR_ROW_COLS), 0.0
+
+    start = pd.to_datetime(df["start"], utc=True, errors="coerce", format="ISO8601")
+    end = pd.to_datetime(df["end"], utc=True, errors="coerce", format="ISO8601")
+    end = end.where(~(end < start), end + pd.Timedelta(days=1))
+
+    duration = (end - start).dt.total_seconds().div(60.0).clip(lower=0).fillna(0.0)
+    people = pd.to_numeric(df["people"], errors="coerce").fillna(0.0).astype(float)
+    man_minutes = duration * people
+
+    out = pd.DataFrame({
+        "sp_item_id": df["sp_item_id"],
+        "start_time": _shown_time(df["start"], start),
+        "end_time": _shown_time(df["end"], end),
+        "people": people,
+        "duration_minutes": duration.round(2),
+        "man_minutes": man_minutes.round(2),
+        "role": df["role"],
+    })
+    return out, float(man_minutes.sum())
+
+
+def _compute_costs(
+    total_boxes: float, ct_per_box: float, loose_ct: float, total_man_minutes: float,
+    raw_kg: float, wastage_kg: float, wage_per_hour: float, material_cost: float,
+    include_extra: bool, extra_pct: float, sell_price_per_ct: float,
+) -> Tuple[float, float, float, float, float, float, float, float, float]:
+    """
+    Pure cost math on plain floats (no field lookups, no I/O).
+    Returns (total_output_ct, minutes_per_ct, wastage_rate_pct, labour_cost_per_ct,
+             material_cost_per_ct, extra_cost_per_ct, total_cost_per_ct, profit_per_ct, profit_total).
+    """
     total_output_ct = total_boxes * ct_per_box + loose_ct
 
-    labour_rows: List[Dict[str, Any]] = []
-    total_man_minutes = 0.0
-
-    for it in labour_items:
-        f = it.get("fields") or {}
-        start_dt = _parse_dt(_get_any(f, LAB_COL_START, None))
-        end_dt = _parse_dt(_get_any(f, LAB_COL_END, None))
-        people = _to_float(_get_any(f, LAB_COL_PEOPLE, 0), 0)
-
-        duration_minutes = 0.0
-        if start_dt and end_dt:
-            if start_dt.tzinfo is None:
-                start_dt = start_dt.replace(tzinfo=timezone.utc)
-            if end_dt.tzinfo is None:
-                end_dt = end_dt.replace(tzinfo=timezone.utc)
-
-            if end_dt < start_dt:
-                end_dt = end_dt + timedelta(days=1)
-
-            duration_minutes = (end_dt - start_dt).total_seconds() / 60.0
-            if duration_minutes < 0:
-                duration_minutes = 0.0
-
-        man_minutes = duration_minutes * people
-        total_man_minutes += man_minutes
-
-        labour_rows.append({
-            "sp_item_id": it.get("id"),
-            "start_time": start_dt.isoformat() if start_dt else "",
-            "end_time": end_dt.isoformat() if end_dt else "",
-            "people": people,
-            "duration_minutes": round(duration_minutes, 2),
-            "man_minutes": round(man_minutes, 2),
-            "role": _to_text(_get_any(f, LAB_COL_ROLE, "")),
-        })
-
     minutes_per_ct = (total_man_minutes / total_output_ct) if total_output_ct > 0 else 0.0
 
-    raw_kg = convert_to_kg(total_raw, raw_unit, unit_weight_kg)
-    wastage_kg = convert_to_kg(wastage, wastage_unit, unit_weight_kg)
-
     wastage_rate_pct = (wastage_kg / raw_kg * 100.0) if raw_kg > 0 else 0.0
 
     labour_cost_per_ct = (minutes_per_ct * (wage_per_hour / 60.0)) if total_output_ct > 0 else 0.0
@@ -471,23 +1038,77 @@ def calc_for_batch(batch_fields: Dict[str, Any], labour_items: List[Dict[str, An
     profit_per_ct = sell_price_per_ct - total_cost_per_ct
     profit_total = profit_per_ct * total_output_ct
 
-    calc = {
-        LOG_TOTALOUTPUT: round(total_output_ct, 4),
-        LOG_TOTALMANMIN: round(total_man_minutes, 4),
-        LOG_MINPERCT: round(minutes_per_ct, 4),
-        LOG_WASTERATE: round(wastage_rate_pct, 4),
-        LOG_LABOURCOST: round(labour_cost_per_ct, 4),
-        LOG_MATCOST: round(material_cost_per_ct, 4),
-        LOG_EXTRACOST: round(extra_cost_per_ct, 4),
-        LOG_TOTALCOST: round(total_cost_per_ct, 4),
-        LOG_PROFITPERCT: round(profit_per_ct, 4),
-        LOG_PROFITTOTAL: round(profit_total, 4),
-        LOG_RAWKG: round(raw_kg, 4),
-        LOG_WASTAGEKG: round(wastage_kg, 4),
-        LOG_CALCAT: datetime.now(timezone.utc).isoformat(),
-    }
+    return (total_output_ct, minutes_per_ct, wastage_rate_pct, labour_cost_per_ct, material_cost_per_ct,
+            extra_cost_per_ct, total_cost_per_ct, profit_per_ct, profit_total)
+
+
+# canonical key -> (coercer, default when the field is blank), in preview order
+BATCH_INPUT_SCHEMA: Tuple[Tuple[str, Any, Any], ...] = (
+    ("TotalBoxes", _to_float, 0),
+    ("CtPerBox", _to_float, 0),
+    ("LooseCT", _to_float, 0),
+    ("TotalRawMaterial", _to_float, 0),
+    ("RawMaterialUnit", _to_text, ""),
+    ("MaterialUnitWeightKg", _to_float, 0),
+    ("Wastage", _to_float, 0),
+    ("WastageUnit", _to_text, "kg"),
+    ("WagePerHour", _to_float, 0),
+    ("MaterialCost", _to_float, 0),
+    ("IncludeExtraCost", _to_bool, False),
+    ("ExtraCostPct", _to_float, 0),
+    ("SellPricePerCT", _to_float, 0),
+)
+
+
+def parse_batch_inputs(bf: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Typed calculation inputs from bf = flatten_fields(batch fields, BATCH_FIELD_ALIASES).
+    Parsed once per rerun; shared by calc_for_batch and the inputs preview.
+    """
+    return {key: coerce(bf.get(key, default)) for key, coerce, default in BATCH_INPUT_SCHEMA}
 
-    return calc, labour_rows
+
+def calc_for_batch(inputs: Dict[str, Any], labour_lines: pd.DataFrame) -> Tuple[Dict[str, Any], pd.DataFrame]:
+    # inputs = parse_batch_inputs(...)
+    total_boxes = inputs["TotalBoxes"]
+    ct_per_box = inputs["CtPerBox"]
+    loose_ct = inputs["LooseCT"]
+
+    total_raw = inputs["TotalRawMaterial"]
+    raw_unit = inputs["RawMaterialUnit"]
+    unit_weight_kg = inputs["MaterialUnitWeightKg"]
+
+    wastage = inputs["Wastage"]
+    wastage_unit = inputs["WastageUnit"]
+
+    wage_per_hour = inputs["WagePerHour"]
+    material_cost = inputs["MaterialCost"]
+
+    include_extra = inputs["IncludeExtraCost"]
+    extra_pct = inputs["ExtraCostPct"]
+
+    sell_price_per_ct = inputs["SellPricePerCT"]
+
+    labour_df, total_man_minutes = aggregate_labour(labour_lines)
+
+    raw_kg = convert_to_kg(total_raw, raw_unit, unit_weight_kg)
+    wastage_kg = convert_to_kg(wastage, wastage_unit, unit_weight_kg)
+
+    (total_output_ct, minutes_per_ct, wastage_rate_pct, labour_cost_per_ct, material_cost_per_ct,
+     extra_cost_per_ct, total_cost_per_ct, profit_per_ct, profit_total) = _compute_costs(
+        total_boxes, ct_per_box, loose_ct, total_man_minutes, raw_kg, wastage_kg,
+        wage_per_hour, material_cost, include_extra, extra_pct, sell_price_per_ct,
+    )
+
+    values = (
+        total_output_ct, total_man_minutes, minutes_per_ct, wastage_rate_pct,
+        labour_cost_per_ct, material_cost_per_ct, extra_cost_per_ct, total_cost_per_ct,
+        profit_per_ct, profit_total, raw_kg, wastage_kg,
+    )
+    calc: Dict[str, Any] = {k: round(v, 4) for k, v in zip(CALC_NUMERIC_KEYS, values)}
+    calc[LOG_CALCAT] = datetime.now(timezone.utc).isoformat()
+
+    return calc, labour_df
 
 
 # =========================================================
@@ -517,12 +1138,15 @@ with st.sidebar:
             site_id = get_site_id()
             pb_list_id = get_list_id_cached(LIST_P_BATCHES)
             cols = graph_list_columns(site_id, pb_list_id)
-            df_cols = pd.DataFrame([{
-                "name(internal)": c.get("name"),
-                "displayName": c.get("displayName"),
-                "type": list((c.get("columnGroup") or {}).keys()) if isinstance(c.get("columnGroup"), dict) else ""
-            } for c in cols])
-            st.dataframe(df_cols, use_container_width=True)
+            col_rows = []
+            for c in cols:
+                group = c.get("columnGroup")
+                col_rows.append({
+                    "name(internal)": c.get("name"),
+                    "displayName": c.get("displayName"),
+                    "type": list(group.keys()) if isinstance(group, dict) else "",
+                })
+            st.dataframe(col_rows, use_container_width=True)
         except Exception as e:
             st.error(str(e))
 
@@ -535,83 +1159,51 @@ with c3:
     load_btn = st.button("Load / Refresh")
 
 if load_btn:
-    st.session_state.pop("_cache_batches", None)
-    st.session_state.pop("_cache_labour", None)
-
-if st.session_state.get("_cache_batches") is None:
     try:
-        batches_items = fetch_p_batches()
-        st.session_state["_cache_batches"] = batches_items
+        reload_lists(start_date, end_date)
     except Exception as e:
         st.error(str(e))
-        batches_items = []
-else:
-    batches_items = st.session_state.get("_cache_batches")
 
-if st.session_state.get("_cache_labour") is None:
-    try:
-        labour_items_all = fetch_labour_lines()
-        st.session_state["_cache_labour"] = labour_items_all
-    except Exception as e:
-        st.error(str(e))
-        labour_items_all = []
-else:
-    labour_items_all = st.session_state.get("_cache_labour")
-
-filtered_batches: List[Dict[str, Any]] = []
-for it in batches_items:
-    f = it.get("fields") or {}
-    wd = _parse_date(_get_any(f, COL_WORKDATE, None))
-    if not wd:
-        continue
-    if wd < start_date or wd > end_date:
-        continue
-    filtered_batches.append(it)
-
-batch_options: List[Tuple[str, str]] = []
-for it in filtered_batches:
-    f = it.get("fields") or {}
-    bn = _get_any(f, COL_BATCHNO, "")
-    wd = _parse_date(_get_any(f, COL_WORKDATE, None))
-    label = f"{bn}".strip()
-    if wd:
-        label = f"{label}  ({wd.isoformat()})"
-    batch_options.append((label, str(it.get("id"))))
+try:
+    batch_options = batch_options_in_range(start_date, end_date)
+except Exception as e:
+    st.error(str(e))
+    batch_options = []
 
 if not batch_options:
     st.info("No batches in this date range (P_Batches).")
     st.stop()
 
+label_to_item: Dict[str, Dict[str, Any]] = dict(batch_options)
 selected_label = st.selectbox("Select BatchNo", options=[x[0] for x in batch_options], index=0)
-selected_item_id = dict(batch_options).get(selected_label)
-
-selected_batch_item = None
-for it in filtered_batches:
-    if str(it.get("id")) == str(selected_item_id):
-        selected_batch_item = it
-        break
+selected_batch_item = label_to_item.get(selected_label)
 
 if not selected_batch_item:
     st.error("Selected batch not found (unexpected).")
     st.stop()
 
-batch_fields = selected_batch_item.get("fields") or {}
-batch_no = _get_any(batch_fields, COL_BATCHNO, "")
+selected_item_id = str(selected_batch_item.get("id"))
+
+batch_fields = flatten_fields(selected_batch_item.get("fields") or {}, BATCH_FIELD_ALIASES)
+batch_no = batch_fields.get("BatchNo", "")
+
+# labour list is only needed once there is a batch to show
+try:
+    labour_lines_all, labour_by_lookup_id, labour_by_text = index_labour_lines()
+except Exception as e:
+    st.error(str(e))
+    labour_lines_all, labour_by_lookup_id, labour_by_text = labour_lines_frame([]), {}, {}
 
-labour_for_batch: List[Dict[str, Any]] = []
 batch_lookup_id_int = _to_int(selected_item_id, 0)
 
-for it in labour_items_all:
-    f = it.get("fields") or {}
-    lk = _to_int(_get_any(f, LAB_COL_BATCH_LOOKUP_ID, 0), 0)
-    if lk and lk == batch_lookup_id_int:
-        labour_for_batch.append(it)
-        continue
-    bt = _to_text(_get_any(f, LAB_COL_BATCH_TEXT, ""))
-    if bt and str(bt).strip() == str(batch_no).strip():
-        labour_for_batch.append(it)
+# match by lookup id OR batch text, keeping the original list order
+labour_pos = set(labour_by_lookup_id.get(batch_lookup_id_int, [])) if batch_lookup_id_int else set()
+if str(batch_no).strip():
+    labour_pos.update(labour_by_text.get(str(batch_no).strip(), []))
+labour_for_batch = labour_lines_all.iloc[sorted(labour_pos)].reset_index(drop=True)
 
-calc, labour_rows = calc_for_batch(batch_fields, labour_for_batch)
+batch_inputs = parse_batch_inputs(batch_fields)
+calc, labour_df = calc_for_batch(batch_inputs, labour_for_batch)
 
 left, right = st.columns(2)
 
@@ -619,28 +1211,17 @@ with left:
     st.subheader("Inputs (from P_Batches)")
     inputs_preview = {
         "BatchNo": batch_no,
-        "WorkDate": _to_text(_get_any(batch_fields, COL_WORKDATE, "")),
-        "PackType": _to_text(_get_any(batch_fields, COL_PACKTYPE, "")),
-        "TotalBoxes": _to_float(_get_any(batch_fields, COL_TOTALBOXES, 0), 0),
-        "CtPerBox": _to_float(_get_any(batch_fields, COL_CTPERBOX, 0), 0),
-        "LooseCT": _to_float(_get_any(batch_fields, COL_LOOSECT, 0), 0),
-        "TotalRawMaterial": _to_float(_get_any(batch_fields, COL_TOTALRAW, 0), 0),
-        "RawMaterialUnit": _to_text(_get_any(batch_fields, COL_RAWUNIT, "")),
-        "MaterialUnitWeightKg": _to_float(_get_any(batch_fields, COL_UNITWEIGHT, 0), 0),
-        "Wastage": _to_float(_get_any(batch_fields, COL_WASTAGE, 0), 0),
-        "WastageUnit": _to_text(_get_any(batch_fields, COL_WASTAGEUNIT, "")),
-        "WagePerHour": _to_float(_get_any(batch_fields, COL_WAGEPH, 0), 0),
-        "MaterialCost": _to_float(_get_any(batch_fields, COL_MATERIALCOST, 0), 0),
-        "IncludeExtraCost": _to_bool(_get_any(batch_fields, COL_INCLUDEEXTRA, False)),
-        "ExtraCostPct": _to_float(_get_any(batch_fields, COL_EXTRAPCT, 0), 0),
-        "SellPricePerCT": _to_float(_get_any(batch_fields, COL_SELLPRICE, 0), 0),
+        "WorkDate": _to_text(batch_fields.get("WorkDate", "")),
+        "PackType": _to_text(batch_fields.get("PackType", "")),
+        **batch_inputs,
+        # show the unit as stored; the calc falls back to kg when it is blank
+        "WastageUnit": _to_text(batch_fields.get("WastageUnit", "")),
     }
-    st.code(json.dumps(inputs_preview, indent=2, ensure_ascii=False), language="json")
+    st.json(inputs_preview)
 
     st.subheader("Labour lines (for this batch)")
-    if labour_rows:
-        df_lab = pd.DataFrame(labour_rows)
-        st.dataframe(df_lab[["start_time", "end_time", "people", "duration_minutes", "man_minutes", "role"]], use_container_width=True)
+    if not labour_df.empty:
+        st.dataframe(labour_df[["start_time", "end_time", "people", "duration_minutes", "man_minutes", "role"]], use_container_width=True)
     else:
         st.info("No labour lines found for this batch (P_LabourLines).")
 
@@ -658,7 +1239,7 @@ with right:
         LOG_PROFITPERCT: calc[LOG_PROFITPERCT],
         LOG_PROFITTOTAL: calc[LOG_PROFITTOTAL],
     }
-    st.code(json.dumps(calc_preview, indent=2, ensure_ascii=False), language="json")
+    st.json(calc_preview)
     st.caption(f"RawKg: {calc.get(LOG_RAWKG, 0)}, WastageKg: {calc.get(LOG_WASTAGEKG, 0)}")
 
     do_save = st.button("Calculate + Save to P_Batches", type="primary")
@@ -668,11 +1249,12 @@ with right:
         try:
             site_id = get_site_id()
             pb_list_id = get_list_id_cached(LIST_P_BATCHES)
-            pl_list_id = get_list_id_cached(LIST_P_LABOUR)
+            write_labour = write_labour_back and not labour_df.empty
+            pl_list_id = get_list_id_cached(LIST_P_LABOUR) if write_labour else None
 
-            # load columns for mapping
-            pb_cols = graph_list_columns(site_id, pb_list_id)
-            pl_cols = graph_list_columns(site_id, pl_list_id)
+            # load columns for mapping (both lists in one $batch call, cached)
+            cols_by_list = fetch_list_columns((pb_list_id, pl_list_id) if pl_list_id else (pb_list_id,))
+            pb_cols = cols_by_list[pb_list_id]
 
             # desired fields (logical -> value + candidates)
             desired_batch = {
@@ -695,33 +1277,33 @@ with right:
                 LOG_CALCAT: (calc.get(LOG_CALCAT, ""), [LOG_CALCAT, "Calculated At"]),
             }
 
-            res = patch_fields_safe_by_guess(
-                site_id=site_id,
-                list_id=pb_list_id,
-                item_id=str(selected_item_id),
-                columns=pb_cols,
-                desired=desired_batch
-            )
+            batch_patch, batch_missing = resolve_fields_patch(pb_cols, desired_batch)
+            jobs = [(pb_list_id, str(selected_item_id), batch_patch)]
 
             # patch labour if needed
-            if write_labour_back and labour_rows:
-                for row in labour_rows:
-                    li_id = str(row["sp_item_id"])
-                    desired_lab = {
-                        LAB_OUT_DURATION: (row["duration_minutes"], [LAB_OUT_DURATION, "Duration Minutes"]),
-                        LAB_OUT_MANMIN: (row["man_minutes"], [LAB_OUT_MANMIN, "Man Minutes"]),
-                    }
-                    patch_fields_safe_by_guess(
-                        site_id=site_id,
-                        list_id=pl_list_id,
-                        item_id=li_id,
-                        columns=pl_cols,
-                        desired=desired_lab
-                    )
-
-            st.success(f"Saved ✅ Patched: {res['patched']}")
-            if res["missing"]:
-                st.warning(f"Skipped (not found in list): {res['missing']}")
+            if write_labour:
+                # same columns for every row: resolve the names once
+                lab_names, _ = resolve_field_names(cols_by_list[pl_list_id], {
+                    LAB_OUT_DURATION: [LAB_OUT_DURATION, "Duration Minutes"],
+                    LAB_OUT_MANMIN: [LAB_OUT_MANMIN, "Man Minutes"],
+                })
+                if not lab_names:
+                    raise Exception("No fields resolved for PATCH (all missing).")
+                for li_id, duration_min, man_min in zip(
+                    labour_df["sp_item_id"].tolist(),
+                    labour_df["duration_minutes"].tolist(),
+                    labour_df["man_minutes"].tolist(),
+                ):
+                    lab_values = {LAB_OUT_DURATION: duration_min, LAB_OUT_MANMIN: man_min}
+                    lab_patch = {internal: lab_values[k] for k, internal in lab_names.items()}
+                    jobs.append((pl_list_id, str(li_id), lab_patch))
+
+            # batch + labour PATCHes go out together as Graph $batch requests
+            graph_batch_patch_items(site_id, jobs)
+
+            st.success(f"Saved ✅ Patched: {list(batch_patch.keys())}")
+            if batch_missing:
+                st.warning(f"Skipped (not found in list): {batch_missing}")
 
         except Exception as e:
             st.error(str(e))